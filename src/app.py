@@ -2,13 +2,12 @@ import json
 import logging
 import os
 import urllib.parse
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import ctypes, ctypes.util
 
 import gc
 
 import boto3
-from botocore.exceptions import ClientError
 import polars as pl
 
 import utils.create_tables as create_tables
@@ -27,76 +26,78 @@ DATA_BUCKET = os.environ.get("DATA_BUCKET", "s3-bucket-dev-lake-analytics")
 HEAD_TO_HEAD_KEY = "bd_bets/head_to_head/head_to_head.parquet"
 HEAD_TO_HEAD_S3_URI = f"s3://{DATA_BUCKET}/{HEAD_TO_HEAD_KEY}"
 
+# Cache de existencia de la base entre invocaciones del mismo contenedor caliente.
+# Solo se cachea True: una vez escrita, la base no desaparece.
+_BASE_EXISTS: Optional[bool] = None
+
+# La base se mantiene ordenada por MatchId y lo indica en los metadatos del
+# parquet: solo así las estadísticas por row group permiten saltar lo que queda
+# fuera del rango del delta. Se cachea igual que _BASE_EXISTS.
+_ORDEN_METADATA = {"head_to_head_sorted_by": "MatchId"}
+_BASE_ORDENADA: Optional[bool] = None
+
+# malloc_trim de glibc, resuelto una sola vez al cargar el módulo
+try:
+    _LIBC = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+    _MALLOC_TRIM = _LIBC.malloc_trim
+    _MALLOC_TRIM.argtypes = [ctypes.c_size_t]
+    _MALLOC_TRIM.restype = ctypes.c_int
+except Exception:
+    logger.error("No se pudo cargar malloc_trim; no se limpiará el heap")
+    _MALLOC_TRIM = None
+
+# gc.collect() + malloc_trim recorren todo el heap: se amortizan cada N mensajes
+# (mínimo 1: con 0 la división del finally fallaría ya escrito el parquet)
+_TRIM_INTERVAL = max(1, int(os.environ.get("TRIM_INTERVAL", "16")))
+_REQ_COUNT = 0
+
 
 # ----------------------------
 # Utilidades S3
 # ----------------------------
 
 def trim_heap():
-    try:
-        libc = ctypes.CDLL(ctypes.util.find_library("c"))
-        libc.malloc_trim(0)  # devuelve páginas al SO si es posible
-    except Exception:
-        logger.error("No se pudo limpiar el heap")
-        pass
+    if _MALLOC_TRIM is not None:
+        _MALLOC_TRIM(0)  # devuelve páginas al SO si es posible
 
 def s3_object_exists(bucket: str, key: str) -> bool:
     """Devuelve True si el objeto S3 existe, False si no existe."""
-    try:
-        s3.head_object(Bucket=bucket, Key=key)
-        return True
-    except ClientError as e:
-        code = e.response.get("Error", {}).get("Code")
-        if code in ("404", "NoSuchKey", "NotFound"):
-            return False
-        # Otros errores (permisos, etc.) se re-lanzan
-        raise
+    # Un único list_objects_v2 (MaxKeys=1) en vez de head_object; errores de
+    # permisos, etc. se propagan como ClientError
+    resp = s3.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+    return any(obj.get("Key") == key for obj in resp.get("Contents", []))
 
 
-# ----------------------------
-# Esquema y cargas
-# ----------------------------
-def head_to_head_schema() -> Dict[str, pl.DataType]:
-    # OJO: si necesitas mantener una columna llamada exactamente "FristComx",
-    # cámbiala aquí y en el resto del pipeline.
-    return {
-        "MatchId": pl.Int64,
-        "BetType": pl.Int64,
-        "HomeId": pl.Int64,
-        "AwayId": pl.Int64,
-        "HtHomeScore": pl.Int64,
-        "HtAwayScore": pl.Int64,
-        "FinalHomeScore": pl.Int64,
-        "FinalAwayScore": pl.Int64,
-        "EventDate": pl.String,
-        "KickOffTime": pl.String,
-        "LeagueId": pl.Int64,
-        "SportId": pl.Int64,
-        "FirstOddsId": pl.Int64,
-        "LastOddsId": pl.Int64,
-        "FirstOdds1": pl.Float64,
-        "LastOdds1": pl.Float64,
-        "FirstOdds2": pl.Float64,
-        "LastOdds2": pl.Float64,
-        "FirstCom1": pl.Float64,
-        "FirstCom2": pl.Float64,
-        "FirstComx": pl.Float64,   # <- corregido de "FristComx"
-        "LastCom1": pl.Float64,
-        "LastCom2": pl.Float64,
-        "LastComx": pl.Float64,        
-        "Winlost_SGD": pl.Float64,
-        "TurnOver_SGD": pl.Float64,
-        "ModifiedOn": pl.String,
-    }
+def base_exists() -> bool:
+    """
+    Indica si la base head_to_head existe en S3. Tras la primera respuesta
+    positiva no vuelve a consultar S3 en el mismo contenedor.
+    """
+    global _BASE_EXISTS
+    if _BASE_EXISTS:
+        return True
+    _BASE_EXISTS = s3_object_exists(DATA_BUCKET, HEAD_TO_HEAD_KEY)
+    return _BASE_EXISTS
 
 
-def empty_head_to_head_lf() -> pl.LazyFrame:
+def base_ordenada() -> bool:
     """
-    Crea un LazyFrame vacío con el esquema esperado.
+    Indica si la base existente se escribió ordenada por MatchId. Solo lee el
+    footer del parquet y, tras la primera respuesta positiva, no vuelve a consultar.
     """
-    return pl.LazyFrame(schema=head_to_head_schema())
+    global _BASE_ORDENADA
+    if _BASE_ORDENADA:
+        return True
+    if not base_exists():
+        return False
+    metadata = pl.read_parquet_metadata(HEAD_TO_HEAD_S3_URI)
+    _BASE_ORDENADA = all(metadata.get(k) == v for k, v in _ORDEN_METADATA.items())
+    return _BASE_ORDENADA
 
 
+# ----------------------------
+# Esquema y cargas
+# ----------------------------
 def load_base_lazyframe() -> pl.LazyFrame:
     """
     Carga el LazyFrame base desde S3 si existe; en caso contrario, devuelve
@@ -104,100 +105,203 @@ def load_base_lazyframe() -> pl.LazyFrame:
     """
     print("DATA_BUCKET",DATA_BUCKET)
     print("HEAD_TO_HEAD_KEY", HEAD_TO_HEAD_KEY)
-    if s3_object_exists(DATA_BUCKET, HEAD_TO_HEAD_KEY):
+    if base_exists():
         logger.info("Cargando base existente: %s", HEAD_TO_HEAD_S3_URI)
         return pl.scan_parquet(HEAD_TO_HEAD_S3_URI)
     else:
         logger.info("No existe base previa. Creando LazyFrame vacío con esquema.")
-        return empty_head_to_head_lf()
+        return upsert_on_head_to_head.empty_head_to_head_lf()
 
 
 # ----------------------------
-# Lógica por registro
+# Lógica por tabla
 # ----------------------------
-def process_record(bucket: str, key: str) -> Dict[str, Any]:
+TABLAS = ("bets", "odds", "match_result")
+
+# Columnas de la base que participan en el upsert de cada tabla: la clave más
+# las que produce su create_head_to_head_*_lazy. El resto se arrastra sin cambios.
+COLUMNAS_UPSERT: Dict[str, List[str]] = {
+    "bets": ["MatchId", "Winlost_SGD", "TurnOver_SGD"],
+    "odds": [
+        "MatchId", "BetType", "FirstOddsId", "LastOddsId",
+        "FirstOdds1", "LastOdds1", "FirstOdds2", "LastOdds2",
+        "FirstCom1", "FirstCom2", "FirstComx",
+        "LastCom1", "LastCom2", "LastComx",
+        "ModifiedOn",
+    ],
+    "match_result": [
+        "MatchId", "HomeId", "AwayId", "HtHomeScore", "HtAwayScore",
+        "FinalHomeScore", "FinalAwayScore", "EventDate", "KickOffTime",
+        "LeagueId", "SportId",
+    ],
+}
+
+
+def create_new_rows_lazy(table_name: str, bucket: str, decoded_key: str) -> pl.LazyFrame:
     """
-    Procesa un único registro del evento S3.
-    Devuelve un dict con el resultado del procesamiento.
+    Construye el LazyFrame con los datos del nuevo objeto según la tabla de origen.
     """
-    # Decodificar key por si trae espacios/utf-8
-    decoded_key = urllib.parse.unquote_plus(key, encoding="utf-8")
-    origin_s3_uri = f"s3://{bucket}/{decoded_key}"
-    logger.info("Nuevo objeto: %s", origin_s3_uri)
-
-    # Cargar base (lazy)
-    base_lf = load_base_lazyframe()
-
-    # Construir el LazyFrame con los datos del nuevo objeto (definido por tus utils)
-    # create_head_to_head_bets_lazy ya devuelve LazyFrame
-    table_name = decoded_key.split("/")[1]
+    logger.info("Tabla: %s", table_name)
     if table_name == "bets":
-        logger.info("Tabla: %s", table_name)
-        new_rows_lf = create_tables.create_head_to_head_bets_lazy(bucket, decoded_key)
+        return create_tables.create_head_to_head_bets_lazy(bucket, decoded_key)
     elif table_name == "odds":
-        logger.info("Tabla: %s", table_name)
-        new_rows_lf = create_tables.create_head_to_head_odds_lazy(bucket, decoded_key)
+        return create_tables.create_head_to_head_odds_lazy(bucket, decoded_key)
     elif table_name == "match_result":
-        logger.info("Tabla: %s", table_name)
-        new_rows_lf = create_tables.create_head_to_head_match_lazy(bucket, decoded_key)
-    else:
-        logger.info("Not found table to update")
-        return {"statusCode": 207, "body": "Not found table to update"}
-
+        return create_tables.create_head_to_head_match_lazy(bucket, decoded_key)
+    raise ValueError(f"Tabla no soportada: {table_name}")
 
-    # upsert_on_head_to_head.upsert espera DataFrames "materializados", según tu código original
-    base_df = base_lf.collect(streaming=True)
-    new_rows_df = new_rows_lf.collect(streaming=True)
 
-    logger.info(
-        "Filas base: %d | Filas nuevas: %d",
-        base_df.height,
-        new_rows_df.height,
-    )
-
-    # Realizar upsert (devuelve DataFrame con el consolidado)
+def upsert_table(
+    table_name: str,
+    base_lf: pl.LazyFrame,
+    new_rows_lf: pl.LazyFrame,
+    esquema: Optional[Dict[str, pl.DataType]] = None,
+) -> pl.LazyFrame:
+    """
+    Aplica el upsert correspondiente a la tabla (devuelve LazyFrame con el consolidado).
+    `esquema` es el schema esperado de la salida si la base llega proyectada.
+    """
+    logger.info("Upsert tabla: %s", table_name)
     if table_name == "bets":
-        logger.info("Upsert tabla: %s", table_name)
-        consolidated_df = upsert_on_head_to_head.upsert_bets(
-            base_df, 
-            new_rows_df, 
-            key="MatchId"
+        return upsert_on_head_to_head.upsert_bets(
+            base_lf, 
+            new_rows_lf, 
+            key="MatchId",
+            esquema=esquema,
             )
     elif table_name == "odds":
-        logger.info("Upsert tabla: %s", table_name)
-        consolidated_df = upsert_on_head_to_head.upsert_odds(
-            base_df, 
-            new_rows_df, 
+        return upsert_on_head_to_head.upsert_odds(
+            base_lf, 
+            new_rows_lf, 
             pk="MatchId", 
             preferir_reciente= ["BetType", "LastOddsId", "LastOdds1", "LastOdds2", "LastCom1", "LastCom2", "LastComx"], 
-            preferir_antiguo=["FirstOddsId", "FirstOdds1", "FirstOdds2", "FirstCom1", "FirstCom2", "FirstComx"]
+            preferir_antiguo=["FirstOddsId", "FirstOdds1", "FirstOdds2", "FirstCom1", "FirstCom2", "FirstComx"],
+            esquema=esquema,
             )
     elif table_name == "match_result":
-        logger.info("Upsert tabla: %s", table_name)
-        consolidated_df = upsert_on_head_to_head.upsert_match(
-            base_df, 
-            new_rows_df, 
-            key="MatchId"
+        return upsert_on_head_to_head.upsert_match(
+            base_lf, 
+            new_rows_lf, 
+            key="MatchId",
+            esquema=esquema,
             )
-    else:
-        logger.info("Not found table to upsert")
-        return {"statusCode": 207, "body": "Not found table to upsert"}
-    
-    # consolidated_df = upsert_on_head_to_head.upsert(base_df, new_rows_df)
+    raise ValueError(f"Tabla no soportada: {table_name}")
+
+
+def _fuera_de_rango(table_name: str, lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Filas de la base que no pasan por el join. upsert_bets deja a 0 (no nulo)
+    las métricas de todas las filas que toca; se replica aquí para que el
+    resultado no dependa del rango del delta.
+    """
+    if table_name == "bets":
+        return lf.with_columns(
+            pl.col("Winlost_SGD").fill_null(0),
+            pl.col("TurnOver_SGD").fill_null(0),
+        )
+    return lf
 
-    # Persistir en parquet en S3 (misma ruta)
-    consolidated_df.write_parquet(HEAD_TO_HEAD_S3_URI)
+
+def process_table(table_name: str, objects: List[Tuple[str, str]]) -> Dict[str, Any]:
+    """
+    Procesa todos los objetos S3 `(bucket, key decodificada)` de una misma tabla:
+    una sola lectura de la base, un upsert por objeto (en orden de llegada)
+    encadenado en el mismo plan, y una sola escritura.
+    """
+    global _BASE_EXISTS, _BASE_ORDENADA
+
+    sources = [f"s3://{bucket}/{decoded_key}" for bucket, decoded_key in objects]
+    for origin_s3_uri in sources:
+        logger.info("Nuevo objeto: %s", origin_s3_uri)
+
+    # Cargar base (lazy)
+    base_lf = load_base_lazyframe()
+
+    # Cada delta ya viene agregado por MatchId (pocas filas): se materializa una
+    # vez para obtener el rango sin volver a escanear los objetos de origen.
+    deltas = [
+        create_new_rows_lazy(table_name, bucket, decoded_key).collect().lazy()
+        for bucket, decoded_key in objects
+    ]
+    rango = pl.concat(
+        [d.select("MatchId") for d in deltas], how="vertical_relaxed"
+    ).select(
+        pl.col("MatchId").min().alias("mn"),
+        pl.col("MatchId").max().alias("mx"),
+    ).collect()
+    mn, mx = rango.item(0, "mn"), rango.item(0, "mx")
+    if mn is None:
+        logger.info("Sin filas nuevas para: %s", sources)
+        return {"statusCode": 207, "body": "No new rows to upsert"}
+    logger.info("Rango MatchId del delta: [%s, %s]", mn, mx)
+
+    # Con la base ordenada, solo el tramo dentro del rango entra al join: el filtro
+    # se empuja al scan y las estadísticas por row group saltan los que no aplican.
+    # Si no lo está (base previa a este formato), un único scan de toda la base
+    # pasa por el upsert y se reescribe ordenada; desde entonces basta el tramo.
+    ordenada = base_ordenada()
+    if ordenada:
+        touched_lf = base_lf.filter(pl.col("MatchId").is_between(mn, mx))
+    else:
+        logger.info("Base sin ordenar por MatchId: se reescribe completa y ordenada")
+        touched_lf = base_lf
+
+    # El pipeline se mantiene lazy: scan -> filter -> group_by -> join -> write
+    # se ejecuta en un único plan, sin materializar la base. Los upserts se
+    # encadenan para conservar la semántica de procesar los objetos uno a uno.
+    if len(deltas) == 1:
+        upserted_lf = upsert_table(table_name, touched_lf, deltas[0])
+    else:
+        # Con varios objetos solo las columnas que el upsert modifica pasan por los
+        # joins encadenados; el resto se recupera del tramo original una sola vez,
+        # por número de fila para no multiplicar filas si un MatchId se repite.
+        esquema = upsert_on_head_to_head.head_to_head_schema()
+        esquema_upsert = {c: esquema[c] for c in COLUMNAS_UPSERT[table_name]}
+        passthrough = [c for c in esquema if c not in esquema_upsert]
+        touched_lf = touched_lf.with_row_index("_fila")
+        upserted_lf = touched_lf.select(["_fila"] + list(esquema_upsert))
+        for new_rows_lf in deltas:
+            upserted_lf = upsert_table(table_name, upserted_lf, new_rows_lf, esquema_upsert)
+        upserted_lf = upserted_lf.join(
+            touched_lf.select(["_fila"] + passthrough), on="_fila", how="left"
+        ).select(list(esquema))
+
+    # Reensamblar: filas fuera del rango intactas y el tramo actualizado ordenado
+    # por MatchId en medio. Cada scan lee solo sus row groups, y el archivo
+    # resultante sigue ordenado por MatchId.
+    if ordenada:
+        consolidated_lf = pl.concat([
+            _fuera_de_rango(table_name, base_lf.filter(pl.col("MatchId").is_null() | (pl.col("MatchId") < mn))),
+            upserted_lf.sort("MatchId"),
+            _fuera_de_rango(table_name, base_lf.filter(pl.col("MatchId") > mx)),
+        ])
+    else:
+        consolidated_lf = upserted_lf.sort("MatchId")
+
+    # Persistir en parquet en S3 (misma ruta): sink_parquet escribe por row groups
+    # sin materializar el consolidado completo en memoria. zstd nivel 1 comprime
+    # casi como snappy y bastante más rápido; las estadísticas por row group
+    # permiten saltarlos en las lecturas siguientes.
+    consolidated_lf.sink_parquet(
+        HEAD_TO_HEAD_S3_URI,
+        compression="zstd",
+        compression_level=1,
+        row_group_size=131_072,
+        statistics=True,
+        metadata=_ORDEN_METADATA,
+    )
     logger.info("Escritura completada en: %s", HEAD_TO_HEAD_S3_URI)
 
+    _BASE_EXISTS = True
+    _BASE_ORDENADA = True
+
     try:
-        del base_df, new_rows_df, consolidated_df
+        del base_lf, deltas, touched_lf, upserted_lf, consolidated_lf
     except NameError:
         pass
-    gc.collect()
-    trim_heap()
 
     return {
-        "source": origin_s3_uri,
+        "sources": sources,
         "target": HEAD_TO_HEAD_S3_URI
     }
 
@@ -226,6 +330,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Handler de AWS Lambda para eventos SQS que contienen eventos S3.
     Procesa todos los Records del evento de forma robusta con partial batch response.
     """
+    global _REQ_COUNT
     __version__ = "1.1.1"
 
     logger.info(f"Version code: {__version__}")
@@ -234,6 +339,10 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     batch_item_failures: List[Dict[str, str]] = []
     results = []
 
+    # 1) Parsear todos los mensajes primero y agruparlos por tabla destino, para
+    #    leer y reescribir la base una sola vez por tabla en lugar de por mensaje
+    grupos: Dict[str, Dict[str, list]] = {}
+
     for record in event.get("Records", []):
         message_id = record.get("messageId")
         body = record.get("body")
@@ -263,20 +372,42 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             batch_item_failures.append({"itemIdentifier": message_id})
             continue
 
+        # Decodificar key por si trae espacios/utf-8
+        decoded_key = urllib.parse.unquote_plus(key, encoding="utf-8")
+        partes = decoded_key.split("/")
+        if len(partes) < 2:
+            logger.error("Cannot derive table name from key=%s", key)
+            batch_item_failures.append({"itemIdentifier": message_id})
+            continue
+
+        table_name = partes[1]
+        if table_name not in TABLAS:
+            logger.info("Not found table to update")
+            results.append({"statusCode": 207, "body": "Not found table to update"})
+            continue
+
+        grupo = grupos.setdefault(table_name, {"message_ids": [], "objects": []})
+        grupo["message_ids"].append(message_id)
+        grupo["objects"].append((bucket, decoded_key))
+
+    # 2) Un upsert + una escritura por tabla
+    for table_name, grupo in grupos.items():
         try:
-            # Usar la lógica existente de process_record
-            res = process_record(bucket, key)
+            res = process_table(table_name, grupo["objects"])
             results.append(res)
-            logger.info("Successfully processed: %s/%s", bucket, key)
+            logger.info("Successfully processed %d objects for table %s", len(grupo["objects"]), table_name)
             
         except Exception as exc:
-            logger.exception("Processing failed for message_id=%s key=%s", message_id, key)
-            # Signal to SQS partial batch response to retry only this item
-            batch_item_failures.append({"itemIdentifier": message_id})
+            logger.exception("Processing failed for table=%s message_ids=%s", table_name, grupo["message_ids"])
+            # La escritura es conjunta: se reintentan todos los mensajes del grupo
+            batch_item_failures.extend({"itemIdentifier": m} for m in grupo["message_ids"])
         finally:
-            # limpieza también entre mensajes del mismo batch
-            gc.collect()
-            trim_heap()
+            # limpieza entre tablas, cada _TRIM_INTERVAL mensajes procesados
+            previo = _REQ_COUNT
+            _REQ_COUNT += len(grupo["message_ids"])
+            if _REQ_COUNT // _TRIM_INTERVAL > previo // _TRIM_INTERVAL:
+                gc.collect()
+                trim_heap()
 
     # Return partial batch response format for SQS
     response = {"batchItemFailures": batch_item_failures}
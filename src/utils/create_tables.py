@@ -1,5 +1,10 @@
 import polars as pl
 
+import utils.upsert_on_head_to_head as upsert_on_head_to_head
+
+# dtypes destino: los deltas salen ya alineados con la base head_to_head
+_SCHEMA = upsert_on_head_to_head.head_to_head_schema()
+
 def create_head_to_head_bets_lazy(bucket, key):
     # bets = pl.scan_parquet(f's3://s3-bucket-prod-lake-zero/bd_bets/bets/day=20250807/')
     bets = pl.scan_parquet(f's3://{bucket}/{key}')
@@ -23,6 +28,7 @@ def create_head_to_head_bets_lazy(bucket, key):
             .alias("Winlost_SGD"),
         )
         .rename({"MatchId": "MatchId"})
+        .cast({c: _SCHEMA[c] for c in ("MatchId", "TurnOver_SGD", "Winlost_SGD")})
     )
 
 def create_head_to_head_match_lazy(bucket, key):
@@ -33,8 +39,17 @@ def create_head_to_head_match_lazy(bucket, key):
 
     return (
         match.filter((pl.col("sportId").is_in([1, 2, 5, 8, 9, 10, 15])))
-        .group_by("matchId")
-        .agg(pl.all().sort_by("modifiedOn").last())
+        # Solo las columnas que se usan: last() sobre todas obligaría a leerlas todas
+        .select(
+            "matchId", "modifiedOn", "homeId", "awayId", "eventDate", "kickOffTime",
+            "finalHomeScore", "finalAwayScore", "htHomeScore", "htAwayScore",
+            "leagueId", "sportId",
+        )
+        # Última versión por partido: un único sort y last() por grupo,
+        # en vez de ordenar cada columna dentro del group_by
+        .sort(["matchId", "modifiedOn"])
+        .group_by("matchId", maintain_order=True)
+        .last()
         .select(
             pl.col("homeId").alias("HomeId"),
             pl.col("awayId").alias("AwayId"),
@@ -48,6 +63,14 @@ def create_head_to_head_match_lazy(bucket, key):
             pl.col("leagueId").alias("LeagueId"),
             pl.col("sportId").alias("SportId")
         )
+        .cast({
+            c: _SCHEMA[c]
+            for c in (
+                "HomeId", "AwayId", "MatchId", "EventDate", "KickOffTime",
+                "FinalHomeScore", "FinalAwayScore", "HtHomeScore", "HtAwayScore",
+                "LeagueId", "SportId",
+            )
+        })
     )
     
 def create_head_to_head_odds_lazy(bucket, key):
@@ -71,6 +94,32 @@ def create_head_to_head_odds_lazy(bucket, key):
         & (pl.col("odds2") == 0.01)
     )
 
+    columnas = [
+        "MatchId", "BetType", "FirstOddsId", "LastOddsId",
+        "FirstOdds1", "LastOdds1", "FirstOdds2", "LastOdds2",
+        "FirstCom1", "FirstCom2", "FirstComx",
+        "LastCom1", "LastCom2", "LastComx",
+        "ModifiedOn"
+    ]
+
+    # Primer/último valor en el tiempo dentro de cada grupo vía arg_min/arg_max
+    # de modifiedOn: evita ordenar globalmente todo el archivo por (match, tiempo).
+    # Se replica el orden ascendente con nulos primero: una fila sin modifiedOn
+    # va delante de todas y, si todas son nulas, la última es la última fila.
+    ts = pl.col("modifiedOn")
+
+    def idx_primero(t):
+        return pl.when(t.is_null().any()).then(t.is_null().arg_max()).otherwise(t.arg_min())
+
+    def idx_ultimo(t):
+        return t.arg_max().fill_null(t.len().cast(pl.Int64) - 1)
+
+    def primero(col, mask):
+        return pl.col(col).filter(mask).get(idx_primero(ts.filter(mask)), null_on_oob=True)
+
+    def ultimo(col, mask):
+        return pl.col(col).filter(mask).get(idx_ultimo(ts.filter(mask)), null_on_oob=True)
+
     return (
     odds
     .filter(
@@ -78,43 +127,35 @@ def create_head_to_head_odds_lazy(bucket, key):
         ~mask_bettype_5 &
         ~mask_bettype_11 
     ) 
-    # Ordenamos globalmente por match y tiempo para que first()/last() respeten el tiempo
-    .sort(["matchId", "modifiedOn"])
     .group_by("matchId")
-    # ... mismo .sort() y .group_by() de antes
 .agg(
-    pl.col("betType").first().alias("BetType"),
+    pl.col("betType").get(idx_primero(ts)).alias("BetType"),
 
     # IDs: si quieres 0 en vez de null y son numéricos, añade fill_null(0).
     # Si son strings, no lo hagas (o usa ""/"0").
-    pl.col("oddsId").filter(mask_pre).first().alias("FirstOddsId"),
-    pl.col("oddsId").filter(mask_live).last().alias("LastOddsId"),
+    primero("oddsId", mask_pre).alias("FirstOddsId"),
+    ultimo("oddsId", mask_live).alias("LastOddsId"),
 
     # Odds 1
-    pl.col("odds1").filter(mask_pre).first().fill_null(0).alias("FirstOdds1"),
-    pl.col("odds1").filter(mask_live).last().fill_null(0).alias("LastOdds1"),
+    primero("odds1", mask_pre).fill_null(0).alias("FirstOdds1"),
+    ultimo("odds1", mask_live).fill_null(0).alias("LastOdds1"),
 
     # Odds 2
-    pl.col("odds2").filter(mask_pre).first().fill_null(0).alias("FirstOdds2"),
-    pl.col("odds2").filter(mask_live).last().fill_null(0).alias("LastOdds2"),
+    primero("odds2", mask_pre).fill_null(0).alias("FirstOdds2"),
+    ultimo("odds2", mask_live).fill_null(0).alias("LastOdds2"),
 
     # Comisiones
-    pl.col("com1").filter(mask_pre).first().fill_null(0).alias("FirstCom1"),
-    pl.col("com2").filter(mask_pre).first().fill_null(0).alias("FirstCom2"),
-    pl.col("comX").filter(mask_pre).first().fill_null(0).alias("FirstComx"),
+    primero("com1", mask_pre).fill_null(0).alias("FirstCom1"),
+    primero("com2", mask_pre).fill_null(0).alias("FirstCom2"),
+    primero("comX", mask_pre).fill_null(0).alias("FirstComx"),
 
-    pl.col("com1").filter(mask_live).last().fill_null(0).alias("LastCom1"),
-    pl.col("com2").filter(mask_live).last().fill_null(0).alias("LastCom2"),
-    pl.col("comX").filter(mask_live).last().fill_null(0).alias("LastComx"),
+    ultimo("com1", mask_live).fill_null(0).alias("LastCom1"),
+    ultimo("com2", mask_live).fill_null(0).alias("LastCom2"),
+    ultimo("comX", mask_live).fill_null(0).alias("LastComx"),
 
-    pl.col("modifiedOn").max().alias("ModifiedOn"),
+    ts.max().alias("ModifiedOn"),
 )
     .rename({"matchId": "MatchId"})
-    .select([
-        "MatchId", "BetType", "FirstOddsId", "LastOddsId",
-        "FirstOdds1", "LastOdds1", "FirstOdds2", "LastOdds2",
-        "FirstCom1", "FirstCom2", "FirstComx",
-        "LastCom1", "LastCom2", "LastComx",
-        "ModifiedOn"
-    ])
+    .select(columnas)
+    .cast({c: _SCHEMA[c] for c in columnas})
 )
\ No newline at end of file
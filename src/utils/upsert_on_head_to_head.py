@@ -1,47 +1,73 @@
 import polars as pl
-from collections.abc import Mapping
-from typing import Iterable, Optional, Sequence
+from typing import Iterable, Optional
 from typing import Dict
 
+# OJO: si necesitas mantener una columna llamada exactamente "FristComx",
+# cámbiala aquí y en el resto del pipeline.
+_SCHEMA: Dict[str, pl.DataType] = {
+    "MatchId": pl.Int64,
+    "BetType": pl.Int64,
+    "HomeId": pl.Int64,
+    "AwayId": pl.Int64,
+    "HtHomeScore": pl.Int64,
+    "HtAwayScore": pl.Int64,
+    "FinalHomeScore": pl.Int64,
+    "FinalAwayScore": pl.Int64,
+    "EventDate": pl.String,
+    "KickOffTime": pl.String,
+    "LeagueId": pl.Int64,
+    "SportId": pl.Int64,
+    "FirstOddsId": pl.Int64,
+    "LastOddsId": pl.Int64,
+    "FirstOdds1": pl.Float64,
+    "LastOdds1": pl.Float64,
+    "FirstOdds2": pl.Float64,
+    "LastOdds2": pl.Float64,
+    "FirstCom1": pl.Float64,
+    "FirstCom2": pl.Float64,
+    "FirstComx": pl.Float64,   # <- corregido de "FristComx"
+    "LastCom1": pl.Float64,
+    "LastCom2": pl.Float64,
+    "LastComx": pl.Float64,        
+    "Winlost_SGD": pl.Float64,
+    "TurnOver_SGD": pl.Float64,
+    "ModifiedOn": pl.String,
+}
+
+
 def head_to_head_schema() -> Dict[str, pl.DataType]:
-    # OJO: si necesitas mantener una columna llamada exactamente "FristComx",
-    # cámbiala aquí y en el resto del pipeline.
-    return {
-        "MatchId": pl.Int64,
-        "BetType": pl.Int64,
-        "HomeId": pl.Int64,
-        "AwayId": pl.Int64,
-        "HtHomeScore": pl.Int64,
-        "HtAwayScore": pl.Int64,
-        "FinalHomeScore": pl.Int64,
-        "FinalAwayScore": pl.Int64,
-        "EventDate": pl.String,
-        "KickOffTime": pl.String,
-        "LeagueId": pl.Int64,
-        "SportId": pl.Int64,
-        "FirstOddsId": pl.Int64,
-        "LastOddsId": pl.Int64,
-        "FirstOdds1": pl.Float64,
-        "LastOdds1": pl.Float64,
-        "FirstOdds2": pl.Float64,
-        "LastOdds2": pl.Float64,
-        "FirstCom1": pl.Float64,
-        "FirstCom2": pl.Float64,
-        "FirstComx": pl.Float64,   # <- corregido de "FristComx"
-        "LastCom1": pl.Float64,
-        "LastCom2": pl.Float64,
-        "LastComx": pl.Float64,        
-        "Winlost_SGD": pl.Float64,
-        "TurnOver_SGD": pl.Float64,
-        "ModifiedOn": pl.String,
-    }
+    """Devuelve una copia del schema destino (el original se construye una vez al importar)."""
+    return dict(_SCHEMA)
+
+
+# Columnas que produce cada create_head_to_head_*_lazy (ver create_tables.py).
+# Son fijas: las columnas en común con la base se calculan una vez al importar
+# el módulo y se usan tal cual cuando la clave es MatchId (el resultado se
+# valida una sola vez con ordenar_y_validar).
+_KEY = "MatchId"
+
+_BETS_COLS = frozenset({"MatchId", "TurnOver_SGD", "Winlost_SGD"})
+_ODDS_COLS = frozenset({
+    "MatchId", "BetType", "FirstOddsId", "LastOddsId",
+    "FirstOdds1", "LastOdds1", "FirstOdds2", "LastOdds2",
+    "FirstCom1", "FirstCom2", "FirstComx",
+    "LastCom1", "LastCom2", "LastComx",
+    "ModifiedOn",
+})
+
+_BETS_OVERLAP = tuple(c for c in _SCHEMA if c in _BETS_COLS and c != _KEY)
+_ODDS_OVERLAP = frozenset(c for c in _SCHEMA if c in _ODDS_COLS and c != _KEY)
+
+
+# Los LazyFrame son inmutables: el vacío con el esquema se crea una sola vez
+_EMPTY_HEAD_TO_HEAD_LF = pl.LazyFrame(schema=_SCHEMA)
 
 
 def empty_head_to_head_lf() -> pl.LazyFrame:
     """
-    Crea un LazyFrame vacío con el esquema esperado.
+    Devuelve un LazyFrame vacío con el esquema esperado.
     """
-    return pl.LazyFrame(schema=head_to_head_schema())
+    return _EMPTY_HEAD_TO_HEAD_LF
 
 
 def load_base_lazyframe() -> pl.LazyFrame:
@@ -53,89 +79,76 @@ def load_base_lazyframe() -> pl.LazyFrame:
     return empty_head_to_head_lf()
 
 def ordenar_y_validar(
-    df: pl.DataFrame,
+    df: pl.LazyFrame,
     esquema: Dict[str, pl.datatypes.DataType],
     *,
     permitir_extras: bool = True,
-) -> pl.DataFrame:
+) -> pl.LazyFrame:
     """
     `esquema` define orden y tipo: {"MatchId": pl.Int64, "modifiedOn": pl.Utf8, ...}
-    - Valida que existan y que los tipos coincidan.
+    - Valida que existan y que los tipos coincidan (contra el schema resuelto del plan).
     - Reordena columnas: primero las del esquema (en ese orden), luego las extras (si se permiten).
     """
     columnas = list(esquema.keys())
+    df_schema = df.collect_schema()
+    df_cols = df_schema.names()
+    df_cols_set = set(df_cols)
 
     # 1) Validar que existan
-    faltan = [c for c in columnas if c not in df.columns]
+    faltan = set(columnas) - df_cols_set
     if faltan:
-        raise ValueError(f"Faltan columnas requeridas: {faltan}")
+        raise ValueError(f"Faltan columnas requeridas: {[c for c in columnas if c in faltan]}")
 
     # 2) Validar tipos (solo para las del esquema)
-    malos = {c: (df.schema[c], esquema[c]) for c in columnas if df.schema.get(c) != esquema[c]}
+    malos = {c: (df_schema[c], esp) for c, esp in esquema.items() if df_schema[c] != esp}
     if malos:
         detalle = ", ".join(f"{c}: {act} != {esp}" for c, (act, esp) in malos.items())
         raise TypeError(f"Tipos no coinciden -> {detalle}")
 
     # 3) Manejar columnas extra
-    extras = [c for c in df.columns if c not in columnas]
+    extras = [c for c in df_cols if c not in esquema]
     if extras and not permitir_extras:
         raise ValueError(f"Columnas no esperadas: {extras}")
 
-    # 4) Reordenar
+    # 4) Reordenar (si ya está en orden, no se añade un select al plan)
+    if df_cols == columnas:
+        return df
     return df.select(columnas + extras)
 
-def _ensure_df_from_schema(x):
-    """Convierte `x` en DataFrame si es un schema (dict/pl.Schema)."""
-    if isinstance(x, pl.DataFrame):
-        return x
-    # intenta construir desde schema (soporta dict o pl.Schema)
-    try:
-        return pl.DataFrame(schema=x)
-    except Exception:
-        pass
-    # intenta convertir a dict y reintentar
-    if isinstance(x, Mapping):
-        return pl.DataFrame(schema=dict(x))
-    raise TypeError(
-        "base debe ser un pl.DataFrame o un schema compatible (dict o pl.Schema)"
-    )
-
-def upsert(base, delta: pl.DataFrame, key: str = "MatchId") -> pl.DataFrame:
-    base = _ensure_df_from_schema(base)
+def upsert(base: pl.LazyFrame, delta: pl.LazyFrame, key: str = "MatchId") -> pl.LazyFrame:
+    # schemas resueltos una sola vez (no materializa el plan)
+    base_schema = base.collect_schema()
+    delta_schema = delta.collect_schema()
 
-    if key not in delta.columns:
+    if key not in delta_schema:
         raise ValueError(f"'delta' debe tener la clave '{key}'")
 
     # si el schema de base no tiene la clave, la creamos (nula) con dtype del delta
-    if key not in base.columns:
-        key_dtype = delta.schema.get(key, pl.Utf8)
+    if key not in base_schema:
+        key_dtype = delta_schema.get(key, pl.Utf8)
         base = base.with_columns(pl.lit(None, dtype=key_dtype).alias(key))
+        base_schema = base.collect_schema()
 
     # columnas en común (excepto la clave)
-    overlap = [c for c in base.columns if c in delta.columns and c != key]
+    overlap = [c for c in base_schema if c in delta_schema and c != key]
 
-    # alinear dtypes del delta a los dtypes de base (incluye la clave)
-    casts = []
-    for c in [key] + overlap:
-        tgt = base.schema[c]
-        if delta.schema.get(c) != tgt:
-            casts.append(pl.col(c).cast(tgt))
-    if casts:
-        delta = delta.with_columns(casts)
+    # alinear dtypes del delta a los dtypes de base (incluye la clave);
+    # cast no hace nada para las columnas que ya coinciden
+    delta = delta.cast({c: base_schema[c] for c in [key] + overlap})
 
     # outer join: aparecen también las filas nuevas del delta
 
-    j = base.join(delta, on=key, how="outer", suffix="_upd", coalesce=True)
+    j = base.join(delta, on=key, how="full", suffix="_upd", coalesce=True)
     print("Join base and delta")
 
     # preferimos delta cuando no es nulo; si delta es nulo, se conserva base
     resolve = [pl.coalesce(pl.col(f"{c}_upd"), pl.col(c)).alias(c) for c in overlap]
 
     # columnas solo de base (incluye la clave y las que no solapan)
-    base_only = [c for c in base.columns if c not in overlap]
+    base_only = [c for c in base_schema if c not in overlap]
 
     # columnas que están solo en delta (y por tanto entran sin sufijo)
-    delta_only = [c for c in delta.columns if c not in overlap and c != key]
+    delta_only = [c for c in delta_schema if c not in overlap and c != key]
 
     # armamos salida manteniendo orden: base_first + resueltas + nuevas de delta
     out = j.select(
@@ -145,155 +158,164 @@ def upsert(base, delta: pl.DataFrame, key: str = "MatchId") -> pl.DataFrame:
     )
     return out
 
-def upsert_match(base, delta: pl.DataFrame, key: str = "MatchId") -> pl.DataFrame:
-    base = _ensure_df_from_schema(base)
+def upsert_match(
+    base: pl.LazyFrame,
+    delta: pl.LazyFrame,
+    key: str = "MatchId",
+    *,
+    esquema: Optional[Dict[str, pl.DataType]] = None,
+) -> pl.LazyFrame:
+    """
+    `esquema` permite validar contra un subconjunto de columnas cuando la base
+    llega proyectada; por defecto, el schema completo de head_to_head.
+    """
+
+    # schemas resueltos una sola vez (no materializa el plan)
+    base_schema = base.collect_schema()
+    delta_schema = delta.collect_schema()
 
-    if key not in delta.columns:
+    if key not in delta_schema:
         raise ValueError(f"'delta' debe tener la clave '{key}'")
 
     # si el schema de base no tiene la clave, la creamos (nula) con dtype del delta
-    if key not in base.columns:
-        key_dtype = delta.schema.get(key, pl.Utf8)
+    if key not in base_schema:
+        key_dtype = delta_schema.get(key, pl.Utf8)
         base = base.with_columns(pl.lit(None, dtype=key_dtype).alias(key))
+        base_schema = base.collect_schema()
 
-    # columnas en común (excepto la clave)
-    overlap = [c for c in base.columns if c in delta.columns and c != key]
-
-    # alinear dtypes del delta a los dtypes de base (incluye la clave)
-    casts = []
-    for c in [key] + overlap:
-        tgt = base.schema[c]
-        if delta.schema.get(c) != tgt:
-            casts.append(pl.col(c).cast(tgt))
-    if casts:
-        delta = delta.with_columns(casts)
-
-    # outer join: aparecen también las filas nuevas del delta
-
-    j = base.join(delta, on=key, how="outer", suffix="_upd", coalesce=True)
-    print("Join base and delta")
-
-    # preferimos delta cuando no es nulo; si delta es nulo, se conserva base
-    resolve = [pl.coalesce(pl.col(f"{c}_upd"), pl.col(c)).alias(c) for c in overlap]
-
-    # columnas solo de base (incluye la clave y las que no solapan)
-    base_only = [c for c in base.columns if c not in overlap]
-
-    # columnas que están solo en delta (y por tanto entran sin sufijo)
-    delta_only = [c for c in delta.columns if c not in overlap and c != key]
+    # alinear dtypes del delta a los dtypes de base (incluye la clave);
+    # cast no hace nada para las columnas que ya coinciden
+    delta = delta.cast({c: base_schema[c] for c in delta_schema if c in base_schema})
 
-    # armamos salida manteniendo orden: base_first + resueltas + nuevas de delta
-    out = j.select(
-        [pl.col(c) for c in base_only] +
-        resolve +
-        [pl.col(c) for c in delta_only]
-    )
-    out_val = ordenar_y_validar(out, head_to_head_schema())
+    # update = outer join + preferir delta cuando no es nulo (si es nulo se
+    # conserva base); aparecen también las filas nuevas del delta
+    out = base.update(delta, on=key, how="full")
+    out_val = ordenar_y_validar(out, esquema or _SCHEMA)
     return out_val
 
-def upsert_bets(base, delta: pl.DataFrame, key: str = "MatchId") -> pl.DataFrame:
-    base = _ensure_df_from_schema(base)
+def upsert_bets(
+    base: pl.LazyFrame,
+    delta: pl.LazyFrame,
+    key: str = "MatchId",
+    *,
+    esquema: Optional[Dict[str, pl.DataType]] = None,
+) -> pl.LazyFrame:
+    """
+    `esquema` permite validar contra un subconjunto de columnas cuando la base
+    llega proyectada; por defecto, el schema completo de head_to_head.
+    """
+
+    # schemas resueltos una sola vez (no materializa el plan)
+    base_schema = base.collect_schema()
+    delta_schema = delta.collect_schema()
 
-    if key not in delta.columns:
+    if key not in delta_schema:
         raise ValueError(f"'delta' debe tener la clave '{key}'")
 
     # si el schema de base no tiene la clave, la creamos (nula) con dtype del delta
-    if key not in base.columns:
-        key_dtype = delta.schema.get(key, pl.Utf8)
+    if key not in base_schema:
+        key_dtype = delta_schema.get(key, pl.Utf8)
         base = base.with_columns(pl.lit(None, dtype=key_dtype).alias(key))
+        base_schema = base.collect_schema()
 
-    # columnas en común (excepto la clave)
-    overlap = [c for c in base.columns if c in delta.columns and c != key]
-
-    base_only = [c for c in base.columns if c not in overlap]
+    if key == _KEY:
+        overlap = list(_BETS_OVERLAP)
+    else:
+        # columnas en común (excepto la clave)
+        overlap = [c for c in base_schema if c in delta_schema and c != key]
+    base_only = [c for c in base_schema if c not in overlap]
 
-    # alinear dtypes del delta a los dtypes de base (incluye la clave)
-    casts = []
-    for c in [key] + overlap:
-        tgt = base.schema[c]
-        if delta.schema.get(c) != tgt:
-            casts.append(pl.col(c).cast(tgt))
-    if casts:
-        delta = delta.with_columns(casts)
+    # alinear dtypes del delta a los dtypes de base (incluye la clave);
+    # cast no hace nada para las columnas que ya coinciden
+    delta = delta.cast({c: base_schema[c] for c in [key] + overlap})
 
     # outer join: aparecen también las filas nuevas del delta
-
-    out = (
-    base.join(delta, on=key, how="outer", suffix="_r")
-      .with_columns([
-          # suma numéricas (si falta en alguno, toma 0)
-          (pl.coalesce([pl.col(c), pl.lit(0)]) +
-           pl.coalesce([pl.col(f"{c}_r"), pl.lit(0)])).alias(c)
-          for c in overlap
-      ] + [
-          # para no numéricas: toma la de df1 si existe, si no la de df2
-          pl.coalesce([pl.col(c), pl.col(f"{c}_r")]).alias(c)
-          for c in base_only
-          if f"{c}_r" in base.join(delta, on=key, how="outer", suffix="_r").columns
-      ])
-      .drop([f"{c}_r" for c in overlap + base_only
-             if f"{c}_r" in base.join(delta, on=key, how="outer", suffix="_r").columns])
-    )
-    out_val = ordenar_y_validar(out, head_to_head_schema())
+    # (un único join; antes se re-ejecutaba para consultar las columnas "_r")
+    joined = base.join(delta, on=key, how="full", coalesce=True, suffix="_r")
+    joined_cols = set(joined.collect_schema().names())
+
+    exprs = [
+        # suma numéricas (si falta en alguno, toma 0)
+        (pl.coalesce([pl.col(c), pl.lit(0)]) +
+         pl.coalesce([pl.col(f"{c}_r"), pl.lit(0)])).alias(c)
+        for c in overlap
+    ] + [
+        # para no numéricas: toma la de df1 si existe, si no la de df2
+        pl.coalesce([pl.col(c), pl.col(f"{c}_r")]).alias(c)
+        for c in base_only
+        if f"{c}_r" in joined_cols
+    ]
+    drop_cols = [f"{c}_r" for c in overlap + base_only if f"{c}_r" in joined_cols]
+
+    out = joined.with_columns(exprs).drop(drop_cols)
+    out_val = ordenar_y_validar(out, esquema or _SCHEMA)
     return out_val
 
 def upsert_odds(
-    df_base: pl.DataFrame,
-    df_delta: pl.DataFrame,
+    df_base: pl.LazyFrame,
+    df_delta: pl.LazyFrame,
     *,
     pk: str = "MatchId",
     ts_col: str = "ModifiedOn",
     preferir_reciente: Optional[Iterable[str]] = None,
     preferir_antiguo: Optional[Iterable[str]] = None,
-) -> pl.DataFrame:
+    esquema: Optional[Dict[str, pl.DataType]] = None,
+) -> pl.LazyFrame:
+    """
+    `esquema` permite validar contra un subconjunto de columnas cuando la base
+    llega proyectada; por defecto, el schema completo de head_to_head.
+    """
     preferir_reciente = set(preferir_reciente or [])
     preferir_antiguo = set(preferir_antiguo or [])
 
-    # 1) Unificar columnas de ambos DFs
-    todas = list({*df_base.columns, *df_delta.columns})
-    if pk not in todas:
+    # base y delta traen una fila por MatchId: basta un outer join y comparar
+    # los dos timestamps una vez por fila (sin concat + sort por columna)
+    base_schema = df_base.collect_schema()
+    delta_schema = df_delta.collect_schema()
+    if pk not in base_schema or pk not in delta_schema:
         raise ValueError(f"Falta la PK '{pk}' en al menos un DataFrame")
-    if ts_col not in todas:
+    if ts_col not in base_schema or ts_col not in delta_schema:
         raise ValueError(f"Falta la columna de timestamp '{ts_col}' en al menos un DataFrame")
 
-    def _alinear(df: pl.DataFrame) -> pl.DataFrame:
-        faltantes = [c for c in todas if c not in df.columns]
-        if faltantes:
-            df = df.with_columns([pl.lit(None).alias(c) for c in faltantes])
-        return df.select(todas)
+    # alinear dtypes del delta a los dtypes de base (incluye la clave);
+    # cast no hace nada para las columnas que ya coinciden
+    df_delta = df_delta.cast({c: base_schema[c] for c in delta_schema if c in base_schema})
+
+    if pk == _KEY:
+        comunes = _ODDS_OVERLAP
+    else:
+        comunes = {c for c in base_schema if c in delta_schema and c != pk}
 
-    a = _alinear(df_base)
-    b = _alinear(df_delta)
+    j = df_base.join(df_delta, on=pk, how="full", suffix="_new", coalesce=True)
 
-    # 2) Apilar filas
-    combo = pl.concat([a, b], how="diagonal")
+    # Preferencia por fila (misma regla que ordenar por [es_nulo, modifiedOn]):
+    # - se prefiere el valor no nulo
+    # - si ambos existen, gana el de timestamp más reciente/antiguo; en empate,
+    #   o si el timestamp de base es nulo, se conserva base
+    ts_base = pl.col(ts_col)
+    ts_new = pl.col(f"{ts_col}_new")
+    tomar_reciente = ts_base.is_not_null() & (ts_new.is_null() | (ts_new > ts_base))
+    tomar_antiguo = ts_base.is_not_null() & (ts_new.is_null() | (ts_new < ts_base))
 
-    # 3) Agregaciones por columna: ordenamos por [es_nulo, modifiedOn]
-    #    - es_nulo ascendente -> primero los NO nulos
-    #    - modifiedOn asc/desc según regla de la columna
-    aggs: Sequence[pl.Expr] = []
-    for c in todas:
+    resolve = []
+    for c in base_schema:
         if c == pk:
             continue
-        # por defecto: preferir más reciente (desc = True)
-        desc = True
-        if c in preferir_antiguo:
-            desc = False
-        elif c in preferir_reciente:
-            desc = True
-        # ordenar sin filtrar para evitar el error de tamaños distintos
-        expr = (
-            pl.col(c)
-            .sort_by(
-                [pl.col(c).is_null(), pl.col(ts_col)],
-                descending=[False, desc],
-            )
-            .first()
+        if c not in comunes:
+            resolve.append(pl.col(c))
+            continue
+        tomar_nuevo = tomar_antiguo if c in preferir_antiguo else tomar_reciente
+        nuevo, viejo = pl.col(f"{c}_new"), pl.col(c)
+        resolve.append(
+            pl.when(tomar_nuevo)
+            .then(pl.coalesce(nuevo, viejo))
+            .otherwise(pl.coalesce(viejo, nuevo))
             .alias(c)
         )
-        aggs.append(expr)
 
-    # 4) Una fila por MatchId
-    resultado = combo.group_by(pk, maintain_order=False).agg(*aggs)
-    resultado_val = ordenar_y_validar(resultado, head_to_head_schema())
-    return resultado_val
\ No newline at end of file
+    # columnas que están solo en delta (entran sin sufijo)
+    delta_only = [pl.col(c) for c in delta_schema if c not in base_schema]
+
+    resultado = j.select([pl.col(pk)] + resolve + delta_only)
+    resultado_val = ordenar_y_validar(resultado, esquema or _SCHEMA)
+    return resultado_val
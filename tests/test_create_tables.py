@@ -0,0 +1,301 @@
+import random
+import pytest
+import polars as pl
+from unittest.mock import patch
+import sys
+import os
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils.create_tables import create_head_to_head_match_lazy, create_head_to_head_odds_lazy
+from utils.upsert_on_head_to_head import head_to_head_schema
+
+ODDS_RAW_SCHEMA = {
+    "matchId": pl.Int64,
+    "betType": pl.Int64,
+    "oddsId": pl.Int64,
+    "odds1": pl.Float64,
+    "odds2": pl.Float64,
+    "com1": pl.Float64,
+    "com2": pl.Float64,
+    "comX": pl.Float64,
+    "liveIndicator": pl.Boolean,
+    "modifiedOn": pl.String,
+}
+
+
+def odds_row(match_id, odds_id, live, modified_on, bet_type=5, odds1=1.5):
+    """Fila cruda de odds; odds2/comisiones se derivan de odds1 para poder seguirlas"""
+    return {
+        "matchId": match_id,
+        "betType": bet_type,
+        "oddsId": odds_id,
+        "odds1": odds1,
+        "odds2": odds1 + 1,
+        "com1": odds1 + 2,
+        "com2": odds1 + 3,
+        "comX": odds1 + 4,
+        "liveIndicator": live,
+        "modifiedOn": modified_on,
+    }
+
+
+def build_odds(rows):
+    """Ejecuta create_head_to_head_odds_lazy sobre `rows` sin acceder a S3"""
+    raw = pl.LazyFrame(rows, schema=ODDS_RAW_SCHEMA)
+    with patch.object(pl, "scan_parquet", return_value=raw):
+        out = create_head_to_head_odds_lazy("src-bucket", "bd_bets/odds/a.parquet").collect()
+    return {r["MatchId"]: r for r in out.to_dicts()}
+
+
+def odds_reference(rows):
+    """
+    Implementación anterior: orden global por (partido, modifiedOn) con nulos
+    primero y first()/last() por grupo. maintain_order fija el orden entre
+    timestamps nulos, igual que el orden del archivo.
+    """
+    pre = pl.col("liveIndicator") == False
+    live = pl.col("liveIndicator") == True
+    out = (
+        pl.DataFrame(rows, schema=ODDS_RAW_SCHEMA)
+        .sort(["matchId", "modifiedOn"], maintain_order=True)
+        .group_by("matchId")
+        .agg(
+            pl.col("betType").first().alias("BetType"),
+            pl.col("oddsId").filter(pre).first().alias("FirstOddsId"),
+            pl.col("oddsId").filter(live).last().alias("LastOddsId"),
+            pl.col("odds1").filter(pre).first().fill_null(0).alias("FirstOdds1"),
+            pl.col("odds1").filter(live).last().fill_null(0).alias("LastOdds1"),
+            pl.col("odds2").filter(pre).first().fill_null(0).alias("FirstOdds2"),
+            pl.col("odds2").filter(live).last().fill_null(0).alias("LastOdds2"),
+            pl.col("com1").filter(pre).first().fill_null(0).alias("FirstCom1"),
+            pl.col("com2").filter(pre).first().fill_null(0).alias("FirstCom2"),
+            pl.col("comX").filter(pre).first().fill_null(0).alias("FirstComx"),
+            pl.col("com1").filter(live).last().fill_null(0).alias("LastCom1"),
+            pl.col("com2").filter(live).last().fill_null(0).alias("LastCom2"),
+            pl.col("comX").filter(live).last().fill_null(0).alias("LastComx"),
+            pl.col("modifiedOn").max().alias("ModifiedOn"),
+        )
+        .rename({"matchId": "MatchId"})
+    )
+    return {r["MatchId"]: r for r in out.to_dicts()}
+
+
+class TestCreateHeadToHeadOdds:
+    """Unit tests for the first/last odds picked per match"""
+
+    def test_no_null_timestamps(self):
+        """First* comes from the oldest pre-match row and Last* from the newest live row"""
+        rows = [
+            odds_row(1, 11, False, "2024-01-02", odds1=1.2),
+            odds_row(1, 10, False, "2024-01-01", bet_type=11, odds1=1.1),
+            odds_row(1, 13, True, "2024-01-04", odds1=1.4),
+            odds_row(1, 12, True, "2024-01-03", odds1=1.3),
+        ]
+
+        row = build_odds(rows)[1]
+
+        assert row["BetType"] == 11
+        assert (row["FirstOddsId"], row["FirstOdds1"], row["FirstComx"]) == (10, 1.1, 5.1)
+        assert (row["LastOddsId"], row["LastOdds1"], row["LastComx"]) == (13, 1.4, 5.4)
+        assert row["ModifiedOn"] == "2024-01-04"
+
+    def test_all_null_timestamps(self):
+        """A group with only null timestamps still yields its first/last rows"""
+        rows = [
+            odds_row(1, 10, False, None, odds1=1.5),
+            odds_row(1, 11, True, None, odds1=1.7),
+        ]
+
+        row = build_odds(rows)[1]
+
+        assert row["BetType"] == 5
+        assert (row["FirstOddsId"], row["LastOddsId"]) == (10, 11)
+        assert (row["FirstOdds1"], row["LastOdds1"]) == (1.5, 1.7)
+        assert row["ModifiedOn"] is None
+
+    def test_some_null_timestamps(self):
+        """Null timestamps sort first: they win First* and lose Last* to any timestamp"""
+        rows = [
+            odds_row(1, 10, False, "2024-01-01", bet_type=11, odds1=1.1),
+            odds_row(1, 11, False, None, odds1=1.2),
+            odds_row(1, 12, True, "2024-01-03", odds1=1.3),
+            odds_row(1, 13, True, None, odds1=1.4),
+        ]
+
+        row = build_odds(rows)[1]
+
+        assert row["BetType"] == 5
+        assert (row["FirstOddsId"], row["FirstOdds1"]) == (11, 1.2)
+        assert (row["LastOddsId"], row["LastOdds1"]) == (12, 1.3)
+        assert row["ModifiedOn"] == "2024-01-03"
+
+    def test_empty_pre_or_live_mask(self):
+        """Without pre-match (or live) rows the ids are null and the values 0"""
+        rows = [
+            odds_row(1, 10, True, "2024-01-01", odds1=1.1),
+            odds_row(2, 20, False, None, odds1=2.1),
+            odds_row(2, 21, False, "2024-01-01", odds1=2.2),
+        ]
+
+        out = build_odds(rows)
+
+        assert (out[1]["FirstOddsId"], out[1]["FirstOdds1"], out[1]["FirstCom1"]) == (None, 0.0, 0.0)
+        assert (out[1]["LastOddsId"], out[1]["LastOdds1"]) == (10, 1.1)
+        assert (out[2]["LastOddsId"], out[2]["LastOdds1"], out[2]["LastComx"]) == (None, 0.0, 0.0)
+        assert (out[2]["FirstOddsId"], out[2]["FirstOdds1"]) == (20, 2.1)
+
+    def test_filtered_rows_are_ignored(self):
+        """Other bet types and 0.01 placeholder rows do not take part"""
+        rows = [
+            odds_row(1, 9, False, "2024-01-01", bet_type=1, odds1=9.9),
+            {**odds_row(1, 8, False, "2024-01-01", odds1=8.8), "com1": 0.01, "com2": 0.01, "comX": 0.01},
+            {**odds_row(1, 7, True, "2024-01-09", bet_type=11), "odds1": 0.01, "odds2": 0.01},
+            odds_row(1, 10, False, "2024-01-02", odds1=1.1),
+        ]
+
+        row = build_odds(rows)[1]
+
+        assert (row["FirstOddsId"], row["LastOddsId"]) == (10, None)
+        assert row["ModifiedOn"] == "2024-01-02"
+
+    def test_matches_sort_based_reference(self):
+        """Random groups give the same result as the global sort + first()/last()"""
+        rng = random.Random(7)
+        rows = []
+        odds_id = 0
+        for match_id in range(300):
+            # timestamps distintos dentro del grupo: con empates el orden no está definido
+            stamps = rng.sample(range(1000), rng.randint(1, 8))
+            for stamp in stamps:
+                odds_id += 1
+                rows.append(odds_row(
+                    match_id,
+                    odds_id,
+                    rng.random() < 0.5,
+                    None if rng.random() < 0.3 else f"2024-01-01T{stamp:05d}",
+                    bet_type=rng.choice([5, 11]),
+                    odds1=round(rng.uniform(1, 5), 2),
+                ))
+
+        assert build_odds(rows) == odds_reference(rows)
+
+
+MATCH_RAW_SCHEMA = {
+    "matchId": pl.Int32,
+    "modifiedOn": pl.String,
+    "homeId": pl.Int32,
+    "awayId": pl.Int32,
+    "eventDate": pl.String,
+    "kickOffTime": pl.String,
+    "finalHomeScore": pl.Int32,
+    "finalAwayScore": pl.Int32,
+    "htHomeScore": pl.Int32,
+    "htAwayScore": pl.Int32,
+    "leagueId": pl.Int32,
+    "sportId": pl.Int32,
+    "status": pl.String,
+}
+
+
+def match_row(match_id, modified_on, home_score, sport_id=1):
+    """Fila cruda de match_result; homeId sigue al marcador para identificar la versión"""
+    return {
+        "matchId": match_id,
+        "modifiedOn": modified_on,
+        "homeId": None if home_score is None else home_score + 100,
+        "awayId": 200,
+        "eventDate": "2024-01-01",
+        "kickOffTime": "20:00",
+        "finalHomeScore": home_score,
+        "finalAwayScore": None if home_score is None else 0,
+        "htHomeScore": home_score,
+        "htAwayScore": 0,
+        "leagueId": 7,
+        "sportId": sport_id,
+        "status": "FT",
+    }
+
+
+def build_match(rows):
+    """Ejecuta create_head_to_head_match_lazy sobre `rows` sin acceder a S3"""
+    raw = pl.LazyFrame(rows, schema=MATCH_RAW_SCHEMA)
+    with patch.object(pl, "scan_parquet", return_value=raw):
+        return create_head_to_head_match_lazy("src-bucket", "bd_bets/match_result/a.parquet").collect()
+
+
+class TestCreateHeadToHeadMatch:
+    """Unit tests for the latest match_result row picked per match"""
+
+    def test_output_columns_and_dtypes(self):
+        """Only the head_to_head columns come out, with the base dtypes"""
+        out = build_match([match_row(1, "2024-01-01", 2)])
+        schema = head_to_head_schema()
+
+        assert set(out.columns) == {
+            "MatchId", "HomeId", "AwayId", "EventDate", "KickOffTime",
+            "FinalHomeScore", "FinalAwayScore", "HtHomeScore", "HtAwayScore",
+            "LeagueId", "SportId",
+        }
+        assert all(out.schema[c] == schema[c] for c in out.columns)
+
+    def test_latest_row_wins_as_a_whole(self):
+        """The newest version is taken whole, nulls included, and null timestamps sort first"""
+        rows = [
+            match_row(1, "2024-01-02", 2),
+            match_row(1, "2024-01-03", None),
+            match_row(1, None, 5),
+            match_row(1, "2024-01-01", 1),
+        ]
+
+        row = build_match(rows).row(0, named=True)
+
+        assert row["FinalHomeScore"] is None
+        assert row["FinalAwayScore"] is None
+        assert row["HomeId"] is None
+
+    def test_other_sports_are_ignored(self):
+        """Rows of sports outside the list do not take part"""
+        rows = [
+            match_row(1, "2024-01-01", 1),
+            match_row(1, "2024-01-05", 9, sport_id=3),
+            match_row(2, "2024-01-01", 1, sport_id=3),
+        ]
+
+        out = build_match(rows)
+
+        assert out["MatchId"].to_list() == [1]
+        assert out["FinalHomeScore"].to_list() == [1]
+
+    def test_matches_per_column_reference(self):
+        """Random groups give the same result as sorting every column inside the group_by"""
+        rng = random.Random(13)
+        rows = []
+        for match_id in range(300):
+            stamps = rng.sample(range(1000), rng.randint(1, 6))
+            for stamp in stamps:
+                rows.append(match_row(
+                    match_id,
+                    f"2024-01-01T{stamp:05d}",
+                    rng.choice([None, 0, 1, 2, 3]),
+                    sport_id=rng.choice([1, 2, 3]),
+                ))
+
+        out = build_match(rows).sort("MatchId")
+        reference = (
+            pl.DataFrame(rows, schema=MATCH_RAW_SCHEMA)
+            .filter(pl.col("sportId").is_in([1, 2, 5, 8, 9, 10, 15]))
+            .group_by("matchId")
+            .agg(pl.all().sort_by("modifiedOn").last())
+            .sort("matchId")
+        )
+
+        assert out["MatchId"].to_list() == reference["matchId"].to_list()
+        assert out["HomeId"].to_list() == reference["homeId"].to_list()
+        assert out["FinalHomeScore"].to_list() == reference["finalHomeScore"].to_list()
+        assert out["SportId"].to_list() == reference["sportId"].to_list()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,288 @@
+import json
+import re
+import pytest
+import polars as pl
+from unittest.mock import patch
+import sys
+import os
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-2')
+
+import app
+
+SCHEMA = app.upsert_on_head_to_head.head_to_head_schema()
+BETS_SCHEMA = {c: SCHEMA[c] for c in ("MatchId", "TurnOver_SGD", "Winlost_SGD")}
+
+
+def sqs_record(message_id, key, bucket="src-bucket"):
+    """Mensaje SQS con un evento S3 dentro del body"""
+    return {
+        "messageId": message_id,
+        "body": json.dumps({"Records": [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}}]}),
+    }
+
+
+def run_process_table(table_name, base_rows, deltas):
+    """
+    Ejecuta process_table con la base y los deltas indicados (uno por objeto),
+    sin S3: create_tables y sink_parquet van mockeados. Recorre tanto la base
+    ordenada (solo el tramo del rango) como la reescritura completa, comprueba
+    que escriben lo mismo y lo devuelve.
+    """
+    base = pl.LazyFrame(base_rows, schema=SCHEMA)
+
+    def fake_sink(lf, *args, **kwargs):
+        escritos.append(lf.collect())
+
+    create_fn = {
+        "bets": "create_head_to_head_bets_lazy",
+        "odds": "create_head_to_head_odds_lazy",
+        "match_result": "create_head_to_head_match_lazy",
+    }[table_name]
+    objects = [("src-bucket", f"bd_bets/{table_name}/{i}.parquet") for i in range(len(deltas))]
+    por_key = {key: delta.lazy() for (_, key), delta in zip(objects, deltas)}
+
+    resultados = []
+    for ordenada in (True, False):
+        escritos = []
+        with patch.object(app, "load_base_lazyframe", return_value=base), \
+             patch.object(app, "base_ordenada", return_value=ordenada), \
+             patch.object(app, "_BASE_EXISTS", False), \
+             patch.object(app, "_BASE_ORDENADA", None), \
+             patch.object(app.create_tables, create_fn, side_effect=lambda bucket, key: por_key[key]), \
+             patch.object(pl.LazyFrame, "sink_parquet", autospec=True, side_effect=fake_sink):
+            app.process_table(table_name, objects)
+        assert len(escritos) == 1
+        resultados.append(escritos[0])
+
+    assert resultados[0].equals(resultados[1])
+    return resultados[0]
+
+
+class TestProcessTable:
+    """Unit tests for the MatchId-range upsert of one table"""
+
+    def test_bets_zero_fill_outside_range(self):
+        """Bets rows outside the delta range get 0 metrics, as a full-table upsert would"""
+        base_rows = [
+            {"MatchId": None, "HomeId": 0},
+            {"MatchId": 1, "HomeId": 10},
+            {"MatchId": 5, "HomeId": 50, "Winlost_SGD": 1.0, "TurnOver_SGD": 2.0},
+            {"MatchId": 9, "HomeId": 90},
+        ]
+        delta = pl.DataFrame({"MatchId": [5], "TurnOver_SGD": [3.0], "Winlost_SGD": [4.0]}, schema=BETS_SCHEMA)
+
+        out = run_process_table("bets", base_rows, [delta])
+
+        assert out.columns == list(SCHEMA)
+        assert out["MatchId"].to_list() == [None, 1, 5, 9]
+        assert out["HomeId"].to_list() == [0, 10, 50, 90]
+        assert out["Winlost_SGD"].to_list() == [0.0, 0.0, 5.0, 0.0]
+        assert out["TurnOver_SGD"].to_list() == [0.0, 0.0, 5.0, 0.0]
+
+    def test_other_tables_keep_rows_outside_range(self):
+        """Outside the range, non-bets tables pass base rows through unchanged"""
+        base_rows = [{"MatchId": 1, "HomeId": 10}, {"MatchId": 9, "HomeId": 90}]
+        delta = pl.DataFrame(
+            {"MatchId": [5], "HomeId": [55]},
+            schema={"MatchId": pl.Int64, "HomeId": pl.Int64},
+        )
+
+        out = run_process_table("match_result", base_rows, [delta])
+
+        assert out["MatchId"].to_list() == [1, 5, 9]
+        assert out["HomeId"].to_list() == [10, 55, 90]
+        assert out["Winlost_SGD"].to_list() == [None, None, None]
+
+    def test_several_objects_chain_in_order(self):
+        """Several objects of one table give the same result as one message each"""
+        base_rows = [
+            {"MatchId": 2, "HomeId": 20, "Winlost_SGD": 1.0, "TurnOver_SGD": 1.0},
+            {"MatchId": 2, "HomeId": 21, "Winlost_SGD": 2.0, "TurnOver_SGD": 2.0},
+        ]
+        deltas = [
+            pl.DataFrame({"MatchId": [2], "TurnOver_SGD": [1.0], "Winlost_SGD": [1.0]}, schema=BETS_SCHEMA),
+            pl.DataFrame({"MatchId": [2, 3], "TurnOver_SGD": [1.0, 7.0], "Winlost_SGD": [1.0, 7.0]}, schema=BETS_SCHEMA),
+        ]
+
+        out = run_process_table("bets", base_rows, deltas).sort("MatchId", "HomeId")
+
+        # un MatchId repetido en la base no multiplica filas al recuperar el resto de columnas
+        assert out["MatchId"].to_list() == [2, 2, 3]
+        assert out["HomeId"].to_list() == [20, 21, None]
+        assert out["Winlost_SGD"].to_list() == [3.0, 4.0, 7.0]
+
+    def test_empty_delta_skips_write(self):
+        """A delta without rows does not rewrite the base"""
+        empty = pl.DataFrame(schema=BETS_SCHEMA)
+
+        with patch.object(app, "load_base_lazyframe", return_value=pl.LazyFrame(schema=SCHEMA)), \
+             patch.object(app.create_tables, "create_head_to_head_bets_lazy", return_value=empty.lazy()), \
+             patch.object(pl.LazyFrame, "sink_parquet") as mock_sink:
+            result = app.process_table("bets", [("src-bucket", "bd_bets/bets/0.parquet")])
+
+        assert result["statusCode"] == 207
+        mock_sink.assert_not_called()
+
+
+class TestLambdaHandlerGrouping:
+    """Unit tests for the per-table grouping of an SQS batch"""
+
+    def test_groups_objects_by_table_in_arrival_order(self):
+        """Each table is processed once with its objects in arrival order"""
+        event = {"Records": [
+            sqs_record("m1", "bd_bets/odds/a.parquet"),
+            sqs_record("m2", "bd_bets/bets/a.parquet"),
+            sqs_record("m3", "bd_bets/odds/b%20c.parquet"),
+            sqs_record("m4", "bd_bets/unknown/a.parquet"),
+        ]}
+
+        with patch.object(app, "process_table", return_value={}) as mock_process:
+            result = app.lambda_handler(event, None)
+
+        assert result == {"batchItemFailures": []}
+        assert [c.args for c in mock_process.call_args_list] == [
+            ("odds", [("src-bucket", "bd_bets/odds/a.parquet"), ("src-bucket", "bd_bets/odds/b c.parquet")]),
+            ("bets", [("src-bucket", "bd_bets/bets/a.parquet")]),
+        ]
+
+    def test_group_failure_reports_every_message_of_the_group(self):
+        """A failed table retries all of its messages and none of the other tables'"""
+        event = {"Records": [
+            sqs_record("m1", "bd_bets/odds/a.parquet"),
+            sqs_record("m2", "bd_bets/bets/a.parquet"),
+            sqs_record("m3", "bd_bets/odds/b.parquet"),
+        ]}
+
+        def side_effect(table_name, objects):
+            if table_name == "odds":
+                raise RuntimeError("Simulated failure")
+            return {}
+
+        with patch.object(app, "process_table", side_effect=side_effect) as mock_process:
+            result = app.lambda_handler(event, None)
+
+        assert mock_process.call_count == 2
+        assert result == {"batchItemFailures": [{"itemIdentifier": "m1"}, {"itemIdentifier": "m3"}]}
+
+    def test_invalid_messages_fail_individually(self):
+        """Unparseable bodies and keys without a table fail on their own"""
+        event = {"Records": [
+            {"messageId": "bad-json", "body": "invalid-json"},
+            sqs_record("no-table", "head_to_head.parquet"),
+            {"messageId": "no-key", "body": json.dumps({"Records": [{"s3": {"bucket": {"name": "b"}}}]})},
+            sqs_record("ok", "bd_bets/bets/a.parquet"),
+        ]}
+
+        with patch.object(app, "process_table", return_value={}) as mock_process:
+            result = app.lambda_handler(event, None)
+
+        mock_process.assert_called_once_with("bets", [("src-bucket", "bd_bets/bets/a.parquet")])
+        assert result == {"batchItemFailures": [
+            {"itemIdentifier": "bad-json"},
+            {"itemIdentifier": "no-table"},
+            {"itemIdentifier": "no-key"},
+        ]}
+
+    def test_one_write_per_table(self):
+        """The whole batch writes the base once per table"""
+        event = {"Records": [
+            sqs_record("m1", "bd_bets/bets/a.parquet"),
+            sqs_record("m2", "bd_bets/bets/b.parquet"),
+            sqs_record("m3", "bd_bets/match_result/a.parquet"),
+        ]}
+        bets = pl.DataFrame({"MatchId": [1], "TurnOver_SGD": [1.0], "Winlost_SGD": [1.0]}, schema=BETS_SCHEMA)
+        match = pl.DataFrame({"MatchId": [1], "HomeId": [10]}, schema={"MatchId": pl.Int64, "HomeId": pl.Int64})
+
+        with patch.object(app, "load_base_lazyframe", return_value=pl.LazyFrame(schema=SCHEMA)), \
+             patch.object(app, "base_exists", return_value=False), \
+             patch.object(app, "_BASE_EXISTS", False), \
+             patch.object(app, "_BASE_ORDENADA", None), \
+             patch.object(app.create_tables, "create_head_to_head_bets_lazy", return_value=bets.lazy()), \
+             patch.object(app.create_tables, "create_head_to_head_match_lazy", return_value=match.lazy()), \
+             patch.object(pl.LazyFrame, "sink_parquet") as mock_sink:
+            result = app.lambda_handler(event, None)
+
+        assert result == {"batchItemFailures": []}
+        assert mock_sink.call_count == 2
+
+
+def run_on_file(base_path, out_path, delta):
+    """
+    Ejecuta process_table("bets", ...) leyendo la base real en `base_path` y
+    escribiendo en `out_path` (no se puede sobrescribir el archivo que se lee).
+    """
+    sink_original = pl.LazyFrame.sink_parquet
+
+    def sink_a_otro(lf, path, **kwargs):
+        sink_original(lf, out_path, **kwargs)
+
+    with patch.object(app, "HEAD_TO_HEAD_S3_URI", str(base_path)), \
+         patch.object(app, "_BASE_EXISTS", True), \
+         patch.object(app, "_BASE_ORDENADA", None), \
+         patch.object(app.create_tables, "create_head_to_head_bets_lazy", return_value=delta.lazy()), \
+         patch.object(pl.LazyFrame, "sink_parquet", autospec=True, side_effect=sink_a_otro):
+        app.process_table("bets", [("src-bucket", "bd_bets/bets/a.parquet")])
+
+
+class TestBaseOrdenada:
+    """Unit tests for keeping the base sorted so out-of-range row groups are skipped"""
+
+    N_FILAS = 500_000
+
+    def unsorted_base(self, path):
+        ids = pl.Series("MatchId", range(self.N_FILAS), dtype=pl.Int64).shuffle(seed=3)
+        pl.DataFrame({"MatchId": ids}).with_columns(
+            pl.lit(1.0).alias("Winlost_SGD"), pl.lit(1.0).alias("TurnOver_SGD")
+        ).select(
+            [pl.col(c) if c in ("MatchId", "Winlost_SGD", "TurnOver_SGD") else pl.lit(None, dtype=t).alias(c)
+             for c, t in SCHEMA.items()]
+        ).write_parquet(path)
+
+    def test_unsorted_base_is_rewritten_sorted(self, tmp_path):
+        """A base without the marker goes through one scan and is written sorted and marked"""
+        base, out = tmp_path / "base.parquet", tmp_path / "out.parquet"
+        self.unsorted_base(base)
+        delta = pl.DataFrame({"MatchId": [7], "TurnOver_SGD": [1.0], "Winlost_SGD": [1.0]}, schema=BETS_SCHEMA)
+
+        run_on_file(base, out, delta)
+
+        written = pl.read_parquet(out)
+        assert written.height == self.N_FILAS
+        assert written["MatchId"].is_sorted()
+        assert written.filter(pl.col("MatchId") == 7)["TurnOver_SGD"].item() == 2.0
+        assert pl.read_parquet_metadata(out)["head_to_head_sorted_by"] == "MatchId"
+
+    def test_out_of_range_scans_are_pruned(self, tmp_path, capfd):
+        """On a sorted base each scan reads only its row groups, about one pass in total"""
+        base, ordenada, out = tmp_path / "base.parquet", tmp_path / "sorted.parquet", tmp_path / "out.parquet"
+        self.unsorted_base(base)
+        delta = pl.DataFrame({"MatchId": [7], "TurnOver_SGD": [1.0], "Winlost_SGD": [1.0]}, schema=BETS_SCHEMA)
+        run_on_file(base, ordenada, delta)
+
+        medio = self.N_FILAS // 2
+        delta = pl.DataFrame({"MatchId": [medio], "TurnOver_SGD": [1.0], "Winlost_SGD": [1.0]}, schema=BETS_SCHEMA)
+        capfd.readouterr()
+        with pl.Config(verbose=True):
+            run_on_file(ordenada, out, delta)
+        leidos = [
+            (int(a), int(b))
+            for a, b in re.findall(r"reading (\d+) / (\d+) row groups", capfd.readouterr().err)
+        ]
+
+        # tres scans de la base: bajo el rango, el rango y sobre el rango
+        assert len(leidos) == 3
+        total = leidos[0][1]
+        assert total > 2
+        assert sorted(a for a, _ in leidos)[0] == 1
+        assert sum(a for a, _ in leidos) <= total + 2
+        written = pl.read_parquet(out)
+        assert written.height == self.N_FILAS
+        assert written["MatchId"].is_sorted()
+        assert written.filter(pl.col("MatchId") == medio)["TurnOver_SGD"].item() == 2.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,169 @@
+import pytest
+import polars as pl
+import sys
+import os
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils.upsert_on_head_to_head import (
+    head_to_head_schema,
+    upsert_bets,
+    upsert_odds,
+)
+
+SCHEMA = head_to_head_schema()
+
+PREFERIR_RECIENTE = ["BetType", "LastOddsId", "LastOdds1", "LastOdds2", "LastCom1", "LastCom2", "LastComx"]
+PREFERIR_ANTIGUO = ["FirstOddsId", "FirstOdds1", "FirstOdds2", "FirstCom1", "FirstCom2", "FirstComx"]
+ODDS_COLS = ["MatchId", "ModifiedOn"] + PREFERIR_RECIENTE + PREFERIR_ANTIGUO
+
+
+def base_lf(*rows):
+    """Base head_to_head con el schema completo; las columnas no indicadas quedan nulas"""
+    return pl.LazyFrame(list(rows), schema=SCHEMA)
+
+
+def odds_delta_lf(*rows):
+    """Delta de odds con las columnas que produce create_head_to_head_odds_lazy"""
+    return pl.LazyFrame(list(rows), schema={c: SCHEMA[c] for c in ODDS_COLS})
+
+
+def run_odds(base, delta):
+    out = upsert_odds(
+        base,
+        delta,
+        pk="MatchId",
+        preferir_reciente=PREFERIR_RECIENTE,
+        preferir_antiguo=PREFERIR_ANTIGUO,
+    ).collect()
+    return {r["MatchId"]: r for r in out.to_dicts()}
+
+
+class TestUpsertOdds:
+    """Unit tests for the per-column precedence of upsert_odds"""
+
+    def test_newer_delta_updates_last_and_keeps_first(self):
+        """A newer delta wins the Last* columns; the older base keeps First*"""
+        base = base_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 1.0, "FirstOdds1": 1.0})
+        delta = odds_delta_lf({"MatchId": 1, "ModifiedOn": "2024-01-02", "LastOdds1": 2.0, "FirstOdds1": 2.0})
+
+        row = run_odds(base, delta)[1]
+
+        assert row["LastOdds1"] == 2.0
+        assert row["FirstOdds1"] == 1.0
+        assert row["ModifiedOn"] == "2024-01-02"
+
+    def test_older_delta_updates_first_and_keeps_last(self):
+        """An older delta wins the First* columns; the newer base keeps Last*"""
+        base = base_lf({"MatchId": 1, "ModifiedOn": "2024-01-02", "LastOdds1": 1.0, "FirstOdds1": 1.0})
+        delta = odds_delta_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 2.0, "FirstOdds1": 2.0})
+
+        row = run_odds(base, delta)[1]
+
+        assert row["LastOdds1"] == 1.0
+        assert row["FirstOdds1"] == 2.0
+        assert row["ModifiedOn"] == "2024-01-02"
+
+    def test_tie_keeps_base(self):
+        """With equal timestamps the base value is kept for every column"""
+        base = base_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 1.0, "FirstOdds1": 1.0})
+        delta = odds_delta_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 2.0, "FirstOdds1": 2.0})
+
+        row = run_odds(base, delta)[1]
+
+        assert row["LastOdds1"] == 1.0
+        assert row["FirstOdds1"] == 1.0
+
+    def test_null_base_timestamp_keeps_base(self):
+        """A null timestamp in base keeps the base values"""
+        base = base_lf({"MatchId": 1, "ModifiedOn": None, "LastOdds1": 1.0, "FirstOdds1": 1.0})
+        delta = odds_delta_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 2.0, "FirstOdds1": 2.0})
+
+        row = run_odds(base, delta)[1]
+
+        assert row["LastOdds1"] == 1.0
+        assert row["FirstOdds1"] == 1.0
+        assert row["ModifiedOn"] == "2024-01-01"
+
+    def test_null_delta_timestamp_takes_delta(self):
+        """A null timestamp in the delta sorts first, so the delta wins both sides"""
+        base = base_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 1.0, "FirstOdds1": 1.0})
+        delta = odds_delta_lf({"MatchId": 1, "ModifiedOn": None, "LastOdds1": 2.0, "FirstOdds1": 2.0})
+
+        row = run_odds(base, delta)[1]
+
+        assert row["LastOdds1"] == 2.0
+        assert row["FirstOdds1"] == 2.0
+        assert row["ModifiedOn"] == "2024-01-01"
+
+    def test_null_value_falls_back_to_other_side(self):
+        """A null value never replaces a non-null one, whatever the timestamps"""
+        base = base_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 1.0, "FirstOdds1": None})
+        delta = odds_delta_lf({"MatchId": 1, "ModifiedOn": "2024-01-02", "LastOdds1": None, "FirstOdds1": 2.0})
+
+        row = run_odds(base, delta)[1]
+
+        assert row["LastOdds1"] == 1.0
+        assert row["FirstOdds1"] == 2.0
+
+    def test_new_and_untouched_rows(self):
+        """Delta-only rows are inserted and base-only rows keep every column"""
+        base = base_lf({"MatchId": 1, "ModifiedOn": "2024-01-01", "LastOdds1": 1.0, "HomeId": 10})
+        delta = odds_delta_lf({"MatchId": 2, "ModifiedOn": "2024-01-01", "LastOdds1": 3.0})
+
+        out = upsert_odds(
+            base,
+            delta,
+            pk="MatchId",
+            preferir_reciente=PREFERIR_RECIENTE,
+            preferir_antiguo=PREFERIR_ANTIGUO,
+        ).collect()
+        rows = {r["MatchId"]: r for r in out.to_dicts()}
+
+        assert out.columns == list(SCHEMA)
+        assert rows[1]["LastOdds1"] == 1.0 and rows[1]["HomeId"] == 10
+        assert rows[2]["LastOdds1"] == 3.0 and rows[2]["HomeId"] is None
+
+
+class TestUpsertBets:
+    """Unit tests for the additive upsert of bet metrics"""
+
+    def test_sums_and_zero_fills(self):
+        """Metrics are summed and nulls count as 0 on every joined row"""
+        base = base_lf(
+            {"MatchId": 1, "Winlost_SGD": 1.0, "TurnOver_SGD": None, "HomeId": 10},
+            {"MatchId": 2, "Winlost_SGD": None, "TurnOver_SGD": None},
+        )
+        delta = pl.LazyFrame(
+            {"MatchId": [1, 3], "TurnOver_SGD": [5.0, 7.0], "Winlost_SGD": [2.0, None]},
+            schema={"MatchId": pl.Int64, "TurnOver_SGD": pl.Float64, "Winlost_SGD": pl.Float64},
+        )
+
+        out = upsert_bets(base, delta).collect()
+        rows = {r["MatchId"]: r for r in out.to_dicts()}
+
+        assert out.columns == list(SCHEMA)
+        assert (rows[1]["Winlost_SGD"], rows[1]["TurnOver_SGD"], rows[1]["HomeId"]) == (3.0, 5.0, 10)
+        assert (rows[2]["Winlost_SGD"], rows[2]["TurnOver_SGD"]) == (0.0, 0.0)
+        assert (rows[3]["Winlost_SGD"], rows[3]["TurnOver_SGD"]) == (0.0, 7.0)
+
+    def test_projected_base(self):
+        """A base projected to the upsert columns validates against `esquema`"""
+        esquema = {c: SCHEMA[c] for c in ("MatchId", "TurnOver_SGD", "Winlost_SGD")}
+        base = pl.LazyFrame({"MatchId": [1], "TurnOver_SGD": [1.0], "Winlost_SGD": [1.0]}, schema=esquema)
+        delta = pl.LazyFrame({"MatchId": [1], "TurnOver_SGD": [1.0], "Winlost_SGD": [1.0]}, schema=esquema)
+
+        out = upsert_bets(base, delta, esquema=esquema).collect()
+
+        assert out.columns == list(esquema)
+        assert out.row(0) == (1, 2.0, 2.0)
+
+    def test_missing_key_in_delta(self):
+        """The delta must carry the key"""
+        with pytest.raises(ValueError, match="MatchId"):
+            upsert_bets(base_lf(), pl.LazyFrame({"TurnOver_SGD": [1.0]}))
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])